@@ -1,6 +1,16 @@
 #!/usr/bin/env python3
 """
-Plantz Editorial Pipeline — Transfer Approved Headlines (v3.2)
+Plantz Editorial Pipeline — Transfer Approved Headlines (v3.3)
+
+v3.3 changes:
+  - Claim, create and cross-reference in batches of 10 records per
+    request instead of one request per headline
+  - Batches are transferred concurrently (max 5 requests in flight)
+  - Restore the headline_queue_id duplicate check, filtered server-side
+    to just the approved IDs instead of scanning the Articles table
+  - Never revert a claim once its articles exist (only the cross-reference
+    write failed), so a failed run can't cause a duplicate transfer
+  - Pace all Airtable requests to 5/sec and retry 429s after Retry-After
 
 v3.2 changes:
   - CLAIM FIRST: Set headline status to 'transferring' BEFORE creating
@@ -18,7 +28,16 @@ Env vars: AIRTABLE_API_KEY, DISCORD_WEBHOOK_NOTIFICATIONS
 import os
 import sys
 import json
+import time
+import asyncio
+import functools
+import inspect
+import threading
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -26,12 +45,17 @@ from pathlib import Path
 env_path = Path(__file__).resolve().parent.parent / ".env"
 if env_path.exists():
     print(f"  Loading .env from {env_path}")
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, _, value = line.partition("=")
-                os.environ.setdefault(key.strip(), value.strip())
+    env_pairs = {}
+    for line in map(str.strip, env_path.read_text().splitlines()):
+        if line and not line.startswith("#") and "=" in line:
+            key, _, value = line.partition("=")
+            # First occurrence of a repeated key wins
+            env_pairs.setdefault(key.strip(), value.strip())
+    # Real environment variables take precedence over .env values
+    os.environ.update({
+        key: value for key, value in env_pairs.items()
+        if key not in os.environ
+    })
 
 # ── Config ──────────────────────────────────────────────────────────────────
 AIRTABLE_API_KEY = os.environ.get("AIRTABLE_API_KEY")
@@ -48,54 +72,387 @@ HEADERS = {
 
 DRY_RUN = "--dry-run" in sys.argv
 
+# Headline Queue fields read when building article records
+HEADLINE_FIELDS = [
+    "headline", "article_prompt", "seo_keyword", "angle", "subject",
+    "batch_id", "target_word_count", "priority_order"
+]
+BATCH_SIZE = 10  # Airtable's max records per create/update request
+MAX_CONCURRENCY = 5  # Airtable allows 5 requests/sec per base
+MAX_APPROVED = 500  # cap per run so a stuck queue can't page forever
+ID_FILTER_CHUNK = 40  # record IDs per OR() formula, keeps URLs well under 16KB
+MAX_RETRIES = 3  # per request, for 429 and 5xx responses
+SERVER_ERRORS = {500, 502, 503, 504}
+RATE_LIMIT_PENALTY = 30  # seconds Airtable locks a base out after a 429
+
+# One pooled session for every Airtable call, so TLS handshakes and TCP
+# connections are reused across requests instead of reopened each time.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=25,
+    # Connection errors only: 429/5xx are retried, paced, by ratelimited()
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        respect_retry_after_header=False,
+        allowed_methods=["GET", "PATCH"]  # never resend article-creating POSTs
+    )
+))
+
+
+# ── Rate Limiting ───────────────────────────────────────────────────────────
+
+class TokenBucket:
+    """Paces requests to `rate` per `per` seconds across the whole run.
+
+    The bucket holds a single token, so there is no burst: sends are
+    spaced per/rate apart. A 429 sets `blocked_until`, which every
+    waiter re-checks before sending.
+    """
+
+    def __init__(self, rate, per):
+        self.interval = per / rate
+        self.next_free = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Claim the next send slot and return its time.monotonic() value."""
+        with self.lock:
+            slot = max(time.monotonic(), self.next_free, self.blocked_until)
+            self.next_free = slot + self.interval
+            return slot
+
+    def is_blocked(self, slot):
+        """True if a lockout that started after `slot` was claimed covers it."""
+        with self.lock:
+            return slot < self.blocked_until
+
+    def penalize(self, seconds):
+        """Block every caller for `seconds` (after a 429)."""
+        with self.lock:
+            self.blocked_until = max(
+                self.blocked_until, time.monotonic() + seconds
+            )
+
+
+AIRTABLE_RATE = TokenBucket(5, 1.0)  # Airtable allows 5 requests/sec per base
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", RATE_LIMIT_PENALTY))
+    except ValueError:
+        return RATE_LIMIT_PENALTY
+
+
+def _backoff(bucket, response, attempt):
+    """Return seconds to back off before retrying `response`, or None.
+
+    A 429 penalizes the shared bucket, so the retry's own slot already
+    waits out the lockout. 5xx errors back off exponentially, but POSTs
+    are never resent: Airtable may already have created the records.
+    """
+    if response.status_code == 429:
+        delay = _retry_after(response)
+        bucket.penalize(delay)
+        print(f"    ⏳ Rate limited by Airtable, retrying in {delay:.0f}s")
+        return 0.0
+    if response.status_code in SERVER_ERRORS and response.request.method != "POST":
+        delay = 0.5 * 2 ** attempt
+        print(f"    ⏳ Airtable returned {response.status_code}, retrying in {delay:.1f}s")
+        return delay
+    return None
+
+
+def ratelimited(bucket):
+    """Pace calls through `bucket` and retry 429s and 5xx errors.
+
+    The wrapped function must return a response. Callers already
+    sleeping on a slot re-check the bucket before sending, so nobody
+    fires into a 429 lockout. Retries are paced like any other request
+    and reuse the same pooled client, so no new connection is opened.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                for attempt in range(MAX_RETRIES + 1):
+                    slot = bucket.reserve()
+                    await asyncio.sleep(max(0.0, slot - time.monotonic()))
+                    while bucket.is_blocked(slot):
+                        slot = bucket.reserve()
+                        await asyncio.sleep(max(0.0, slot - time.monotonic()))
+                    response = await func(*args, **kwargs)
+                    delay = None
+                    if attempt < MAX_RETRIES:
+                        delay = _backoff(bucket, response, attempt)
+                    if delay is None:
+                        return response
+                    await asyncio.sleep(delay)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                for attempt in range(MAX_RETRIES + 1):
+                    slot = bucket.reserve()
+                    time.sleep(max(0.0, slot - time.monotonic()))
+                    while bucket.is_blocked(slot):
+                        slot = bucket.reserve()
+                        time.sleep(max(0.0, slot - time.monotonic()))
+                    response = func(*args, **kwargs)
+                    delay = None
+                    if attempt < MAX_RETRIES:
+                        delay = _backoff(bucket, response, attempt)
+                    if delay is None:
+                        return response
+                    time.sleep(delay)
+        return wrapper
+    return decorator
+
 
 # ── Airtable Helpers ────────────────────────────────────────────────────────
 
-def airtable_get(table_id, params=None):
+@ratelimited(AIRTABLE_RATE)
+def _request(method, url, **kwargs):
+    return SESSION.request(method, url, **kwargs)
+
+
+def airtable_iter(table_id, params=None, max_records=None):
+    """Yield records one page at a time, following offset pagination."""
     url = f"https://api.airtable.com/v0/{BASE_ID}/{table_id}"
-    all_records = []
+    params = dict(params or {}, pageSize=100)
+    if max_records:
+        params["maxRecords"] = max_records
+    fetched = 0
     while True:
-        response = requests.get(url, headers=HEADERS, params=params)
+        response = _request("GET", url, params=params)
         response.raise_for_status()
-        data = response.json()
-        all_records.extend(data.get("records", []))
+        data = orjson.loads(response.content)
+        records = data.get("records", [])
+        fetched += len(records)
+        yield from records
         offset = data.get("offset")
-        if not offset:
-            break
-        if params is None:
-            params = {}
+        if not offset or (max_records and fetched >= max_records):
+            return
         params["offset"] = offset
-    return all_records
 
 
-def airtable_get_record(table_id, record_id):
-    """Fetch a single record to check its current state."""
-    response = requests.get(
-        f"https://api.airtable.com/v0/{BASE_ID}/{table_id}/{record_id}",
-        headers=HEADERS
-    )
+def airtable_get(table_id, params=None, max_records=None):
+    return list(airtable_iter(table_id, params, max_records))
+
+
+def get_existing_headline_ids(headline_ids):
+    """Return which of the given headline IDs already have an article.
+
+    Filters server-side on headline_queue_id so only the matching
+    articles are downloaded, not the whole Articles table.
+    """
+    existing = set()
+    for ids in chunked(headline_ids, ID_FILTER_CHUNK):
+        formula = "OR(" + ",".join(f'{{headline_queue_id}} = "{i}"' for i in ids) + ")"
+        # Airtable omits empty cells, so a present key always has a value
+        existing |= {
+            r["fields"]["headline_queue_id"]
+            for r in airtable_iter(ARTICLES_TABLE, params={
+                "filterByFormula": formula,
+                "fields[]": "headline_queue_id"
+            })
+            if "headline_queue_id" in r.get("fields", ())
+        }
+    return existing
+
+
+def chunked(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _send(method, url, payload):
+    """Send a JSON body serialized with orjson and decode the reply."""
+    response = _request(method, url, data=orjson.dumps(payload))
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
+
+
+def airtable_batch_update(table_id, records):
+    """Update records ({"id": ..., "fields": ...}) in batches of 10."""
+    url = f"https://api.airtable.com/v0/{BASE_ID}/{table_id}"
+    updated = []
+    for batch in chunked(records):
+        updated.extend(_send("PATCH", url, {"records": batch})["records"])
+    return updated
 
 
-def airtable_create_record(table_id, fields):
-    response = requests.post(
+# ── Async Batch Transfer ────────────────────────────────────────────────────
+
+@ratelimited(AIRTABLE_RATE)
+async def _arequest(client, semaphore, method, url, **kwargs):
+    async with semaphore:
+        return await client.request(method, url, **kwargs)
+
+
+async def _get_statuses(client, semaphore, table_id, record_ids):
+    """Fetch the current status of up to 10 records in one request."""
+    formula = "OR(" + ",".join(f'RECORD_ID() = "{rid}"' for rid in record_ids) + ")"
+    response = await _arequest(
+        client, semaphore, "GET",
         f"https://api.airtable.com/v0/{BASE_ID}/{table_id}",
-        headers=HEADERS,
-        json={"records": [{"fields": fields}]}
+        params={"filterByFormula": formula, "fields[]": "status"}
     )
     response.raise_for_status()
-    return response.json()["records"][0]
+    return {
+        r["id"]: r.get("fields", {}).get("status", "")
+        for r in orjson.loads(response.content).get("records", [])
+    }
 
 
-def airtable_update_record(table_id, record_id, fields):
-    response = requests.patch(
+async def _send_batch(client, semaphore, method, table_id, batch):
+    response = await _arequest(
+        client, semaphore, method,
         f"https://api.airtable.com/v0/{BASE_ID}/{table_id}",
-        headers=HEADERS,
-        json={"records": [{"id": record_id, "fields": fields}]}
+        content=orjson.dumps({"records": batch})
     )
     response.raise_for_status()
-    return response.json()["records"][0]
+    return orjson.loads(response.content)["records"]
+
+
+async def _post_batch(client, semaphore, table_id, batch):
+    return await _send_batch(client, semaphore, "POST", table_id, batch)
+
+
+async def _patch_batch(client, semaphore, table_id, batch):
+    return await _send_batch(client, semaphore, "PATCH", table_id, batch)
+
+
+def build_article_fields(rec):
+    """Map a Headline Queue record onto a new Articles record."""
+    f = rec["fields"]
+    return {
+        "article_title": f.get("headline", ""),
+        "prompt": f.get("article_prompt", ""),
+        "seo_keyword": f.get("seo_keyword", ""),
+        "angle": f.get("angle", ""),
+        "subject": f.get("subject", ""),
+        "batch_id": f.get("batch_id", ""),
+        "target_word_count": f.get("target_word_count", 1000),
+        "headline_queue_id": rec["id"],
+        "pipeline_status": "queued",
+        "priority_order": f.get("priority_order", 1)
+    }
+
+
+def headline_rows(recs, prefix):
+    """One terminal row per headline: title and record ID."""
+    return "\n".join(
+        f"{prefix}{(rec['fields'].get('headline') or '(no title)')[:60]} ({rec['id']})"
+        for rec in recs
+    )
+
+
+async def transfer_batch(client, semaphore, batch):
+    """Claim, create and cross-reference one batch of up to 10 headlines."""
+    created = []
+    skipped = []
+    claimed = []
+
+    try:
+        # Re-check status (another run may have already claimed some)
+        statuses = await _get_statuses(
+            client, semaphore, HEADLINE_TABLE, [rec["id"] for rec in batch]
+        )
+        for rec in batch:
+            if statuses.get(rec["id"], "") != "approved":
+                skipped.append(rec)
+            else:
+                claimed.append(rec)
+        if skipped:
+            print("\n".join(
+                "    ⏭️  " + (rec["fields"].get("headline") or "(no title)")[:60]
+                + " — already claimed (status: " + statuses.get(rec["id"], "") + ")"
+                for rec in skipped
+            ))
+
+        if not claimed:
+            return created, skipped
+
+        # CLAIM: Set status BEFORE creating articles
+        await _patch_batch(client, semaphore, HEADLINE_TABLE, [
+            {"id": rec["id"], "fields": {"status": "sent_to_news_agent"}}
+            for rec in claimed
+        ])
+
+        # Create article records
+        articles = await _post_batch(client, semaphore, ARTICLES_TABLE, [
+            {"fields": build_article_fields(rec)} for rec in claimed
+        ])
+
+        created.extend(articles)
+        print(headline_rows(claimed, "    ✓ Created article: "))
+
+        # Store cross-references
+        await _patch_batch(client, semaphore, HEADLINE_TABLE, [
+            {"id": rec["id"], "fields": {"articles_record_id": article["id"]}}
+            for rec, article in zip(claimed, articles)
+        ])
+
+    except Exception as e:
+        print(
+            f"    ✗ Batch of {len(batch)} headline(s) — ERROR: {e}\n"
+            + headline_rows(batch, "      • ")
+        )
+        if created:
+            # The articles exist, so keep the claim: reverting to 'approved'
+            # would queue these headlines for a duplicate transfer.
+            # Nothing re-runs for claimed headlines, so name them for a
+            # manual articles_record_id fix.
+            print(
+                "      ⚠ Cross-references not stored; headline status left as claimed."
+                " Set articles_record_id by hand:\n"
+                + "\n".join(
+                    f"        • {rec['id']} → {article['id']}"
+                    f" ({(rec['fields'].get('headline') or '(no title)')[:60]})"
+                    for rec, article in zip(claimed, created)
+                )
+            )
+        elif claimed:
+            # Try to revert status if article creation failed
+            try:
+                await _patch_batch(client, semaphore, HEADLINE_TABLE, [
+                    {"id": rec["id"], "fields": {"status": "approved"}}
+                    for rec in claimed
+                ])
+                print(f"      ↩ Reverted {len(claimed)} headline status(es) to 'approved'")
+            except Exception:
+                print(f"      ⚠ Could not revert headline status")
+
+    return created, skipped
+
+
+async def transfer_all(approved):
+    """Run every batch concurrently, capped at MAX_CONCURRENCY requests."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    async with httpx.AsyncClient(
+        headers=HEADERS,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY,
+            max_keepalive_connections=MAX_CONCURRENCY
+        ),
+        timeout=30.0
+    ) as client:
+        results = await asyncio.gather(*(
+            transfer_batch(client, semaphore, batch)
+            for batch in chunked(approved)
+        ))
+
+    created_articles = []
+    skipped = []
+    for created, batch_skipped in results:
+        created_articles.extend(created)
+        skipped.extend(batch_skipped)
+    return created_articles, skipped
 
 
 # ── Discord Notification ────────────────────────────────────────────────────
@@ -119,7 +476,7 @@ def notify_discord(message, color=5814783):
 
 def main():
     print("=" * 60)
-    print("PLANTZ EDITORIAL PIPELINE v3.2 — Headline Transfer")
+    print("PLANTZ EDITORIAL PIPELINE v3.3 — Headline Transfer")
     print(f"Time: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}")
     if DRY_RUN:
         print("MODE: DRY RUN (no changes will be made)")
@@ -131,8 +488,9 @@ def main():
     approved = airtable_get(HEADLINE_TABLE, params={
         "filterByFormula": '{status} = "approved"',
         "sort[0][field]": "priority_order",
-        "sort[0][direction]": "asc"
-    })
+        "sort[0][direction]": "asc",
+        "fields[]": HEADLINE_FIELDS
+    }, max_records=MAX_APPROVED)
 
     if not approved:
         print("  No approved headlines found. Nothing to transfer.")
@@ -140,87 +498,64 @@ def main():
 
     print(f"  Found {len(approved)} approved headline(s)")
 
+    # ── Step 2: Skip headlines that already have an article ──
+    existing_ids = get_existing_headline_ids([rec["id"] for rec in approved])
+    already_transferred = [rec for rec in approved if rec["id"] in existing_ids]
+    approved = [rec for rec in approved if rec["id"] not in existing_ids]
+
+    if already_transferred:
+        print("\n".join(
+            "    ⏭️  " + (rec["fields"].get("headline") or "(no title)")[:60]
+            + " — already has an article"
+            for rec in already_transferred
+        ))
+
+    # Repair stuck headlines: they have an article but are still 'approved'
+    if already_transferred and not DRY_RUN:
+        try:
+            airtable_batch_update(HEADLINE_TABLE, [
+                {"id": rec["id"], "fields": {"status": "sent_to_news_agent"}}
+                for rec in already_transferred
+            ])
+            print(f"    🔧 Set {len(already_transferred)} stuck headline(s) to 'sent_to_news_agent'")
+        except Exception as e:
+            print(f"    ⚠ Could not repair stuck headline status: {e}")
+
+    if not approved:
+        print("  All approved headlines have already been transferred.")
+        return
+
     if DRY_RUN:
-        for rec in approved:
-            print(f"    • {rec['fields'].get('headline', '(no title)')}")
+        print("\n".join(
+            "    • " + (rec["fields"].get("headline") or "(no title)")
+            for rec in approved
+        ))
         print(f"\n🔍 DRY RUN — would transfer {len(approved)} headline(s)")
         return
 
-    # ── Step 2: Claim and transfer each headline ──
+    # ── Step 3: Claim and transfer headlines in batches of 10 ──
     # v3.2: CLAIM FIRST by setting status to 'transferring' before creating
     # the article. This prevents duplicates when two runs overlap.
+    # v3.3: each step is one request per batch, and batches run concurrently.
     print(f"\n📝 Claiming and transferring {len(approved)} headline(s)...")
 
-    created_articles = []
-    skipped = []
-
-    for rec in approved:
-        f = rec["fields"]
-        title = f.get("headline", "(no title)")
-
-        try:
-            # Re-check status (another run may have already claimed it)
-            fresh = airtable_get_record(HEADLINE_TABLE, rec["id"])
-            current_status = fresh.get("fields", {}).get("status", "")
-
-            if current_status != "approved":
-                print(f"    ⏭️  {title[:60]} — already claimed (status: {current_status})")
-                skipped.append(rec)
-                continue
-
-            # CLAIM: Set status to 'transferring' BEFORE creating article
-            airtable_update_record(HEADLINE_TABLE, rec["id"], {
-                "status": "sent_to_news_agent"
-            })
-            print(f"    🔒 Claimed: {title[:60]}")
-
-            # Create article record
-            article = airtable_create_record(ARTICLES_TABLE, {
-                "article_title": f.get("headline", ""),
-                "prompt": f.get("article_prompt", ""),
-                "seo_keyword": f.get("seo_keyword", ""),
-                "angle": f.get("angle", ""),
-                "subject": f.get("subject", ""),
-                "batch_id": f.get("batch_id", ""),
-                "target_word_count": f.get("target_word_count", 1000),
-                "headline_queue_id": rec["id"],
-                "pipeline_status": "queued",
-                "priority_order": f.get("priority_order", 1)
-            })
-
-            # Store cross-reference
-            airtable_update_record(HEADLINE_TABLE, rec["id"], {
-                "articles_record_id": article["id"]
-            })
-
-            created_articles.append(article)
-            print(f"    ✓ Created article: {title[:60]}")
-
-        except Exception as e:
-            print(f"    ✗ {title[:60]} — ERROR: {e}")
-            # Try to revert status if article creation failed
-            try:
-                airtable_update_record(HEADLINE_TABLE, rec["id"], {
-                    "status": "approved"
-                })
-                print(f"      ↩ Reverted headline status to 'approved'")
-            except Exception:
-                print(f"      ⚠ Could not revert headline status")
-            continue
+    created_articles, skipped = asyncio.run(transfer_all(approved))
 
-    # ── Step 3: Summary ──
+    # ── Step 4: Summary ──
     print("\n" + "=" * 60)
     print("TRANSFER COMPLETE")
     print(f"  Headlines transferred: {len(created_articles)}")
+    if already_transferred:
+        print(f"  Already transferred (skipped): {len(already_transferred)}")
     if skipped:
         print(f"  Already claimed (skipped): {len(skipped)}")
     print("=" * 60)
 
-    # ── Step 4: Discord notification ──
+    # ── Step 5: Discord notification ──
     if created_articles:
         titles = "\n".join(
-            [f"• {a['fields'].get('article_title', '(no title)')}"
-             for a in created_articles]
+            f"• {a['fields'].get('article_title', '(no title)')}"
+            for a in created_articles
         )
         notify_discord(
             f"**📋 {len(created_articles)} headline(s) transferred to Articles queue**\n\n"